@@ -1,35 +1,56 @@
 """Abstraction model for interfacing with Waveshare SIM7080X NB-IoT HAT
 """
+import asyncio
 import logging
-import math
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from time import sleep
-from typing import TypedDict
+from time import monotonic
+from typing import Callable, Iterator, TypedDict
 
 import serial
 from gpiozero import DigitalOutputDevice
 
 _log = logging.getLogger(__name__)
 
+_OK = b'OK'
+_ERROR = b'ERROR'
+_PROMPT = b'>'
+_DOWNLOAD = b'DOWNLOAD'
+_AT_TERMINATORS = (_OK, _ERROR, _DOWNLOAD)
+_AT_ERROR_PREFIXES = (b'+CME ERROR', b'+CMS ERROR')
+_DEFAULT_BAUDRATE = 9600
+_LOG_TRANS = str.maketrans({'\r': '<cr>', '\n': '<lf>'})
+_CNACT_RE = re.compile(rb'\+CNACT: (\d+),\d+,"([^"]+)"')
+
+
+def _read_file(filename: str) -> bytes:
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def _is_final_response(line: bytes) -> bool:
+    """True if the line ends an AT command response."""
+    return (line in _AT_TERMINATORS or
+            line.startswith(_AT_ERROR_PREFIXES) or
+            line.startswith(_PROMPT))
+
 
 class DataService(Enum):
     """Data service aka ip_type used for +CGDCONT and +CGNCFG"""
-    DUAL_PDN: 0
-    IP_V4: 1
-    IP_V6: 2
-    NONIP: 3
-    EX_NONIP: 4
+    DUAL_PDN = 0
+    IP_V4 = 1
+    IP_V6 = 2
+    NONIP = 3
+    EX_NONIP = 4
     
     def __repr__(self):
-        if self.name == 'NONIP':
-            return 'Non-IP'
-        elif self.name == 'IP_V4':
-            return 'IP'
-        elif self.name == 'IP_V6':
-            return 'IPV6'
-        elif self.name == 'DUAL_PDN':
-            return 'IPV4V6'
+        return self._repr
+    
+    def __str__(self):
+        return self._repr
     
     @property
     def is_ip(self) -> bool:
@@ -38,14 +59,24 @@ class DataService(Enum):
         return True
 
 
+DataService.DUAL_PDN._repr = 'IPV4V6'
+DataService.IP_V4._repr = 'IP'
+DataService.IP_V6._repr = 'IPV6'
+DataService.NONIP._repr = 'Non-IP'
+DataService.EX_NONIP._repr = 'Non-IP'
+
+
 class AuthType(Enum):
-    NONE: 0
-    PAP: 1
-    CHAP: 2
-    PAP_CHAP: 3
+    NONE = 0
+    PAP = 1
+    CHAP = 2
+    PAP_CHAP = 3
 
 
 class PdpContext:
+    __slots__ = ('id', 'apn', 'data_service', 'ip_address', 'configured',
+                 'username', 'password', 'auth')
+    
     def __init__(self,
                  id: int,
                  apn: str,
@@ -53,7 +84,7 @@ class PdpContext:
                  ) -> None:
         self.id: int = id or 0
         self.apn: str = apn or ''
-        self.data_service: DataService = data_service or DataService.IP
+        self.data_service: DataService = data_service or DataService.IP_V4
         self.ip_address: 'str|None' = None
         self.configured: bool = False
         self.username: str = None
@@ -66,31 +97,64 @@ class PdpContext:
 
 
 class PdpAction(Enum):
-    DEACTIVATE: 0
-    ACTIVATE: 1
-    AUTO_ACTIVATE: 2
+    DEACTIVATE = 0
+    ACTIVATE = 1
+    AUTO_ACTIVATE = 2
 
 
 class WaveshareNbiotHat:
     """A Waveshare SIM7080X NB-IoT HAT."""
-    def __init__(self, uart: str = '/dev/ttyS0', power_pin: int = 4) -> None:
-        self._baudrate: int = 9600
-        self.uart = serial.Serial(uart, self._baudrate, timeout=1.0)
+    __slots__ = ('_baudrate', 'uart', 'power_pin', '_ready', '_rf_enabled',
+                 '_pdp_contexts', '_active_pdp_context', '_mqtt_connected',
+                 '_rx_buf', '_rx_view', '_urc_handlers', '_at_queue',
+                 '_uart_lock')
+    _CMD_AT = b'AT\r'
+    _CMD_CFUN0 = b'AT+CFUN=0\r'
+    _CMD_CFUN1 = b'AT+CFUN=1\r'
+    _CMD_GCATT = b'AT+GCATT?\r'
+    _CMD_GCNAPN = b'AT+GCNAPN\r'
+    _CMD_CNACT = b'AT+CNACT?\r'
+    _CMD_CCLK = b'AT+CCLK?\r'
+    _CMD_SMCONN = b'AT+SMCONN\r'
+    _CMD_SMDISC = b'AT+SMDISC\r'
+    _CMD_CFSINIT = b'AT+CFSINIT\r'
+    _CMD_CFSTERM = b'AT+CFSTERM\r'
+    _CMD_CSSLCFG_CA = b'AT+CSSLCFG="CONVERT",2,"ca.crt"\r'
+    _CMD_CSSLCFG_CLIENT = b'AT+CSSLCFG="CONVERT",1,"client.crt","client.key"\r'
+    _CMD_SMSSL = b'AT+SMSSL=1,"ca.crt","client.crt"\r'
+    
+    def __init__(self,
+                 uart: str = '/dev/ttyS0',
+                 power_pin: int = 4,
+                 baudrate: int = 115200) -> None:
+        self._baudrate: int = baudrate
+        self.uart = serial.Serial(uart,
+                                  _DEFAULT_BAUDRATE,
+                                  timeout=0.05,
+                                  write_timeout=1.0)
+        try:
+            self.uart.set_low_latency_mode(True)
+        except (AttributeError, OSError, ValueError):
+            _log.debug('UART low latency mode not supported')
         self.power_pin = DigitalOutputDevice(power_pin)
         self._ready: bool = None
         self._rf_enabled: bool = None
-        self._pdp_contexts: dict = {}
+        self._pdp_contexts: 'list[PdpContext|None]' = [None] * 4
         self._active_pdp_context: int = None
         self._mqtt_connected: bool = True
-        # self._at_queue = None
+        self._rx_buf = bytearray(2048)
+        self._rx_view = memoryview(self._rx_buf)
+        self._urc_handlers: 'dict[bytes, Callable[[bytes], None]]' = {}
+        self._at_queue = ThreadPoolExecutor(max_workers=1)
+        self._uart_lock = threading.RLock()
     
     @property
     def active_pdp_context(self) -> int:
         return self._active_pdp_context
     
     @property
-    def pdp_contexts(self) -> dict:
-        return self._pdp_contexts
+    def pdp_contexts(self) -> 'dict[int, PdpContext]':
+        return {i: c for i, c in enumerate(self._pdp_contexts) if c}
     
     def power_on(self):
         _log.debug('Powering on SIM7080G')
@@ -100,57 +164,305 @@ class WaveshareNbiotHat:
         _log.debug('Powering off SIM7080G')
         self.power_pin.blink(2, 5, n=1)
     
-    def initialize(self, max_attempts: int = 3) -> bool:
+    def initialize(self, max_attempts: int = 8) -> bool:
+        """Wait for the module to respond, powering it on if necessary.
+        
+        The `AT` probe timeout starts short and doubles on each attempt up
+        to 2 seconds, so an already running module is found in one round
+        trip while a cold module gets enough time to boot (~5 seconds).
+        
+        """
         responsive = False
-        attempt = 0
-        while not responsive and attempt < max_attempts:
-            attempt += 1
-            res = self.at_command('AT', timeout=1)
-            if 'OK' in res:
+        delay = 0.1
+        for attempt in range(max_attempts):
+            if self._probe(timeout=delay):
                 responsive = True
-            else:
+                break
+            if attempt == 0:
                 _log.debug('Attempting module power on')
                 self.power_on()
+            delay = min(delay * 2, 2.0)
+        if responsive:
+            responsive = self._negotiate_baudrate()
         self._ready = responsive
         return self._ready
     
+    def _probe(self, timeout: float) -> bool:
+        """Check for a response at the current UART rate, then the other.
+        
+        The module keeps a previously negotiated rate until it reboots, so
+        the configured baudrate is tried as well as the 9600 default.
+        
+        """
+        rates = [self.uart.baudrate, _DEFAULT_BAUDRATE, self._baudrate]
+        for baudrate in dict.fromkeys(rates):
+            self.uart.baudrate = baudrate
+            if _OK in self.at_command(self._CMD_AT, timeout=timeout):
+                return True
+        return False
+    
+    def _negotiate_baudrate(self) -> bool:
+        """Switch the module and UART to the configured baudrate.
+        
+        If the module does not respond at the new rate, both rates are
+        probed again to re-establish the link.
+        
+        Returns:
+            True if the module responds at the resulting UART baudrate.
+        
+        """
+        if self.uart.baudrate == self._baudrate:
+            return True
+        res = self.at_command(f'AT+IPR={self._baudrate}')
+        if _OK not in res:
+            _log.warning(f'Unable to set baudrate {self._baudrate}: {res}')
+            return True
+        self.uart.flush()
+        self.uart.baudrate = self._baudrate
+        if _OK in self.at_command(self._CMD_AT, timeout=1):
+            _log.debug(f'UART baudrate set to {self._baudrate}')
+            return True
+        _log.warning(f'No response at {self._baudrate} baud - probing')
+        if self._probe(timeout=1):
+            return True
+        _log.error('Module not responding after baudrate change')
+        return False
+    
     @property
     def ready(self) -> bool:
         if self._ready is None:
             self.initialize()
         return self._ready
         
-    def at_command(self, command: str, timeout: float = 0.1) -> 'list[str]':
-        if self.uart.in_waiting:
-            buffer = self.uart.read(self.uart.in_waiting)
-            debug = buffer.decode().replace('\r', '<cr>').replace('\n', '<lf>')
-            _log.warning(f'Buffer contained: {debug}')
-        self.uart.reset_input_buffer()
-        self.uart.write(f'{command}\r'.encode())
-        sleep(timeout)
-        response: 'list[str]' = []
-        while self.uart.in_waiting:
-            line = self.uart.read_until('\r\n'.encode()).decode()
-            if line.strip():
-                response.append(line.strip())
-        _log.debug(f'Command {command} response: {response}')
+    def on_urc(self, prefix: str, handler: 'Callable[[bytes], None]') -> None:
+        """Register a handler for unsolicited result codes.
+        
+        Received lines that start with `prefix` (e.g. `+SMSUB:`) are passed
+        to `handler` instead of being discarded or returned in a command
+        response, unless they are the response the command expects.
+        
+        Args:
+            prefix: The URC prefix to match.
+            handler: Called with the complete URC line as `bytes`, on the
+                thread running the command or `process_urcs`. For commands
+                sent with `at_command_async` that is the command queue worker
+                thread, not the event loop thread.
+        
+        """
+        self._urc_handlers[prefix.encode()] = handler
+    
+    def _dispatch_urc(self, line: bytes) -> bool:
+        """Pass the line to a matching URC handler, if one is registered."""
+        for prefix, handler in self._urc_handlers.items():
+            if line.startswith(prefix):
+                handler(line)
+                return True
+        return False
+    
+    def _handle_unsolicited(self, data: bytes) -> None:
+        """Route unsolicited lines to URC handlers and log the remainder."""
+        unhandled = []
+        for line in data.split(b'\r\n'):
+            line = line.strip()
+            if line and not self._dispatch_urc(line):
+                unhandled.append(line)
+        if unhandled and _log.isEnabledFor(logging.WARNING):
+            debug = b'\r\n'.join(unhandled).decode(errors='replace')
+            _log.warning(f'Buffer contained: {debug.translate(_LOG_TRANS)}')
+    
+    def _flush_input(self) -> None:
+        """Clear unsolicited data waiting in the receive buffer."""
+        buffer = self.uart.read(self.uart.in_waiting)
+        if buffer:
+            self._handle_unsolicited(buffer)
+    
+    def process_urcs(self, timeout: float) -> None:
+        """Wait up to `timeout` seconds and route any URCs received.
+        
+        There is no background reader, so handlers registered with `on_urc`
+        are only called while a command or `process_urcs` is running.
+        
+        """
+        with self._uart_lock:
+            for line in self._read_lines(timeout):
+                self._handle_unsolicited(line)
+    
+    def _read_lines(self, timeout: float) -> Iterator[bytes]:
+        """Yield non-empty response lines until `timeout` seconds elapse.
+        
+        Received data is read into a persistent buffer and lines are found
+        by scanning for `<cr><lf>` in place. Only the stripped lines handed
+        back are copied out, since the buffer is reused by the next read.
+        A line longer than the buffer is accumulated until it completes.
+        A trailing partial line starting with the `>` prompt is yielded
+        as-is because the modem does not terminate it.
+        
+        """
+        buf = self._rx_buf
+        view = self._rx_view
+        start = end = 0
+        overflow = bytearray()
+        deadline = monotonic() + timeout
+        try:
+            while monotonic() < deadline:
+                if start == end:
+                    start = end = 0
+                elif end == len(buf):
+                    if start == 0:   # line longer than the buffer
+                        # keep the last byte in case it is a split <cr><lf>
+                        overflow += view[:end - 1]
+                        view[:1] = view[end - 1:end]
+                        end = 1
+                    else:
+                        view[:end - start] = view[start:end]
+                        end -= start
+                        start = 0
+                size = min(len(buf) - end, self.uart.in_waiting or 1)
+                end += self.uart.readinto(view[end:end + size])
+                while (eol := buf.find(b'\r\n', start, end)) != -1:
+                    if overflow:
+                        overflow += view[start:eol]
+                        line = bytes(overflow).strip()
+                        overflow.clear()
+                    else:
+                        line = bytes(view[start:eol]).strip()
+                    start = eol + 2
+                    if line:
+                        yield line
+                if not overflow and buf.startswith(_PROMPT, start, end):
+                    line = bytes(view[start:end]).strip()
+                    start = end
+                    yield line
+        finally:
+            if overflow or start < end:
+                self._handle_unsolicited(bytes(overflow + view[start:end]))
+    
+    def _read_response(self,
+                       timeout: float,
+                       expect: 'bytes|None' = None,
+                       solicited: 'tuple[bytes, ...]' = ()) -> 'list[bytes]':
+        """Collect response lines up to and including the final result code.
+        
+        If `expect` is given and the command returns `OK`, reading continues
+        until a line starting with `expect` is received or `timeout` expires.
+        Lines matching a registered URC prefix are passed to their handler
+        instead, unless they start with `expect` or one of `solicited`.
+        
+        """
+        response: 'list[bytes]' = []
+        completed = False
+        exempt = solicited + (expect,) if expect is not None else solicited
+        for line in self._read_lines(timeout):
+            if not line.startswith(exempt) and self._dispatch_urc(line):
+                continue
+            response.append(line)
+            if expect is not None and line.startswith(expect):
+                expect = None
+                if completed:
+                    break
+            elif _is_final_response(line):
+                if line != _OK or expect is None:
+                    break
+                completed = True
         return response
     
+    def at_command(self,
+                   command: 'bytes|str',
+                   timeout: float = 5,
+                   expect: 'bytes|None' = None) -> 'list[bytes]':
+        """Send an AT command and collect the response lines.
+        
+        Returns as soon as a final result code (`OK`, `ERROR`, `+CME ERROR`,
+        `+CMS ERROR`) or a data prompt (`>`, `DOWNLOAD`) is received, or
+        after `timeout` seconds if the modem does not complete the response.
+        Response lines are returned as stripped `bytes`.
+        
+        Args:
+            command: The AT command. A `str` is encoded and terminated with
+                `<cr>`, `bytes` must already include the `<cr>`.
+            timeout: The maximum time to wait for the response.
+            expect: The prefix of an unsolicited result code that the modem
+                sends after `OK` (e.g. `+CPIN:`) to wait for as part of the
+                response.
+        
+        """
+        if isinstance(command, str):
+            command = f'{command}\r'.encode()
+        solicited = ()
+        if command.startswith(b'AT+') and command.endswith(b'?\r'):
+            solicited = (b'+' + command[3:-2] + b':',)   # read command info
+        with self._uart_lock:
+            self._flush_input()
+            self.uart.write(command)
+            response = self._read_response(timeout, expect, solicited)
+        if _log.isEnabledFor(logging.DEBUG):
+            decoded = [line.decode(errors='replace') for line in response]
+            _log.debug(f'Command {command.decode().strip()} response: {decoded}')
+        return response
+    
+    async def at_command_async(self,
+                               command: 'bytes|str',
+                               timeout: float = 5,
+                               expect: 'bytes|None' = None) -> 'list[bytes]':
+        """Send an AT command without blocking the event loop.
+        
+        Commands are queued to a single worker thread so concurrent callers
+        are sent in the order they were issued. Each UART transaction holds
+        a lock, so blocking methods called from other threads are not
+        interleaved with queued commands. Arguments are as for `at_command`.
+        
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._at_queue,
+                                          self.at_command,
+                                          command,
+                                          timeout,
+                                          expect)
+    
+    def close(self) -> None:
+        """Stop the command queue and close the UART."""
+        self._at_queue.shutdown(wait=True)
+        with self._uart_lock:
+            self.uart.close()
+    
+    def _at_batch(self,
+                  commands: 'list[bytes]',
+                  timeout: float = 5) -> 'list[bytes]':
+        """Send several extended AT commands on a single command line.
+        
+        The commands are concatenated with `;` after one `AT` prefix, as
+        allowed by V.250, so the modem runs them in order and returns a
+        single final result code. Execution stops at the first command
+        that fails. The whole line must fit the modem's command line
+        buffer.
+        
+        Args:
+            commands: The encoded extended commands without the `AT` prefix
+                or `<cr>`, e.g. `b'+SMCONF="CLEANSS",1'`.
+            timeout: The maximum time to wait for the combined response.
+        
+        Returns:
+            The response lines for the command line.
+        
+        """
+        return self.at_command(b''.join([b'AT', b';'.join(commands), b'\r']),
+                               timeout)
+    
     def disable_rf(self) -> bool:
-        res = self.at_command('AT+CFUN=0')
-        if 'OK' not in res:
+        res = self.at_command(self._CMD_CFUN0, expect=b'+CPIN: NOT READY')
+        if _OK not in res:
             _log.error(f'Error: {res}')
             return False
-        if '+CPIN: NOT READY' not in res:
+        if b'+CPIN: NOT READY' not in res:
             return False
         return True
             
     def enable_rf(self) -> bool:
-        res = self.at_command('AT+CFUN=1')
-        if 'OK' not in res:
+        res = self.at_command(self._CMD_CFUN1, expect=b'+CPIN: READY')
+        if _OK not in res:
             _log.error(f'Error: {res}')
             return False
-        if '+CPIN: READY' not in res:
+        if b'+CPIN: READY' not in res:
             return False
         return True
             
@@ -167,20 +479,23 @@ class WaveshareNbiotHat:
         # TODO: +CGDCONT seems redundant to +CNCFG
         if not self.disable_rf():
             raise RuntimeError('Could not disable RF')
-        res = self.at_command(f'AT+CGDCONT={id},"{str(data_service)}","{apn}"')
+        res = self.at_command(b''.join([
+            b'AT+CGDCONT=', str(id).encode(),
+            b',"', str(data_service).encode(), b'","', apn.encode(), b'"\r']))
         # TODO: allows specification of static PDP_addr, d_comp, h_comp, ipv4_ctrl, emergency_flag
-        if 'OK' not in res:
+        if _OK not in res:
             raise ValueError(f'Error: {res}')
         if not self.enable_rf():
             raise RuntimeError('Could not enable RF')
         if data_service.is_ip:
-            res = self.at_command('AT+GCATT?')
-            if '+CGATT: 1' not in res:
+            res = self.at_command(self._CMD_GCATT)
+            if b'+CGATT: 1' not in res:
                 raise SystemError('Packet service not attached')
         # TODO: unclear if +GGNAPN is required seems to indicate registered
-        res = self.at_command('AT+GCNAPN')
-        if f'+CGNAPN: {id},"{apn}"' not in res:
+        res = self.at_command(self._CMD_GCNAPN)
+        if f'+CGNAPN: {id},"{apn}"'.encode() not in res:
             raise ValueError(f'Error: {res}')
+        self._pdp_contexts[id] = PdpContext(id, apn, data_service)
         
     def pdp_context_configure(self,
                               id: int,
@@ -189,7 +504,7 @@ class WaveshareNbiotHat:
                               username: str = '',
                               password: str = '',
                               auth: 'AuthType|None' = None) -> None:
-        if id not in self._pdp_contexts:
+        if id not in range(0, 4) or self._pdp_contexts[id] is None:
             raise ValueError(f'PDP context ID {id} not defined')
         pdp_context: PdpContext = self._pdp_contexts[id]
         if not apn:
@@ -197,17 +512,20 @@ class WaveshareNbiotHat:
         if not data_service:
             data_service = pdp_context.data_service
         # TODO: unclear if +CGCFG required if no username/password/auth
-        config_command = f'AT+CNCFG={id},"{str(data_service)}","{apn}"'
+        config_command = [b'AT+CNCFG=', str(id).encode(),
+                          b',"', str(data_service).encode(),
+                          b'","', apn.encode(), b'"']
         if username:
-            config_command += f',{username}'
+            config_command += [b',', username.encode()]
             if password:
-                config_command += f',{password}'
+                config_command += [b',', password.encode()]
         if auth:
             if not username and not password:
-                config_command += ',,'
-            config_command += f',{auth.value}'
-        res = self.at_command(config_command)
-        if 'OK' not in res:
+                config_command.append(b',,')
+            config_command += [b',', str(auth.value).encode()]
+        config_command.append(b'\r')
+        res = self.at_command(b''.join(config_command))
+        if _OK not in res:
             raise ValueError(f'Error: {res}')
         pdp_context.username = username
         pdp_context.password = password
@@ -217,44 +535,54 @@ class WaveshareNbiotHat:
     def pdp_context_activate(self,
                              pdp_context_id: int = 0,
                              action: PdpAction = PdpAction.ACTIVATE) -> bool:
-        if pdp_context_id not in self._pdp_contexts:
+        if (pdp_context_id not in range(0, 4) or
+            self._pdp_contexts[pdp_context_id] is None):
             raise ValueError(f'PDP context ID {pdp_context_id} not defined')
         pdp_context: PdpContext = self._pdp_contexts[pdp_context_id]
         if not pdp_context.configured:
             raise ValueError(f'PDP context ID {pdp_context_id} not configured')
-        res = self.at_command(f'AT+CNACT={pdp_context_id},{action.value}')
-        if f'+APP PDP: {pdp_context_id},{action.name}' not in res:
+        res = self.at_command(f'AT+CNACT={pdp_context_id},{action.value}',
+                              expect=b'+APP PDP:')
+        if f'+APP PDP: {pdp_context_id},{action.name}'.encode() not in res:
             _log.error(f'Failed to confirm PDP context actvation: {res}')
         if pdp_context.is_ip:
             if action == PdpAction.DEACTIVATE:
                 pdp_context.ip_address = None
                 self._active_pdp_context = None
             else:
-                res = self.at_command('AT+CNACT?')
+                res = self.at_command(self._CMD_CNACT)
                 for line in res:
-                    if line.startswith(f'+CNACT: {pdp_context_id}'):
-                        pdp_context.ip_address = (
-                            line.split(',')[2].replace('"', ''))
+                    m = _CNACT_RE.match(line)
+                    if m and int(m.group(1)) == pdp_context_id:
+                        pdp_context.ip_address = m.group(2).decode()
                         self._active_pdp_context = pdp_context_id
                         break
     
-    def _put_file_in_flash(self, filename: str, flashname: str) -> None:
-        """"""
-        res = self.at_command('AT+CFSINIT')
-        if not 'OK' in res:
+    def _cfs_begin(self) -> None:
+        """Open the flash filesystem buffer for one or more writes."""
+        res = self.at_command(self._CMD_CFSINIT)
+        if not _OK in res:
             raise SyntaxError(f'Could not initialize filesystem: {res}')
-        size = os.path.getsize(filename)
-        res = self.at_command(f'AT+CFSWFILE=3,"{flashname}",0,{size},1000')
-        if 'DOWNLOAD' not in res:
-            raise SystemError(f'Error opening download: {res}')
-        self.uart.write(open(filename, 'rb').read())
-        sleep(math.ceil(size * 8 / self._baudrate))   #: TODO is this necessary?
-        if self.uart.in_waiting:
-            res = self.uart.read(self.uart.in_waiting).decode().strip()
-            if 'OK' not in res:
+    
+    def _cfs_write(self, data: bytes, flashname: str) -> None:
+        """Write a file to flash between `_cfs_begin` and `_cfs_end`."""
+        with self._uart_lock:
+            res = self.at_command(
+                f'AT+CFSWFILE=3,"{flashname}",0,{len(data)},1000')
+            if _DOWNLOAD not in res:
+                raise SystemError(f'Error opening download: {res}')
+            view = memoryview(data)
+            for offset in range(0, len(view), 256):
+                self.uart.write(view[offset:offset + 256])
+            self.uart.flush()
+            res = self._read_response(timeout=5)
+            if _OK not in res:
                 raise SystemError(f'Error downloading file: {res}')
-        res = self.at_command('AT+CFSTERM')
-        if not 'OK' in res:
+    
+    def _cfs_end(self) -> None:
+        """Close the flash filesystem buffer."""
+        res = self.at_command(self._CMD_CFSTERM)
+        if not _OK in res:
             raise SystemError(f'Failed to close file buffer: {res}')
         
     def pdp_context_configure_ssl(self,
@@ -268,26 +596,30 @@ class WaveshareNbiotHat:
             raise FileNotFoundError(f'{cert_file} certificate not found')
         if not os.path.isfile(key_file):
             raise FileNotFoundError(f'{key_file} key not found')
-        if not self._active_pdp_context:
+        if self._active_pdp_context is None:
             raise SystemError('No active PDP context')
         if not self._pdp_contexts[self._active_pdp_context].ip_address:
             raise SystemError('No valid IP address')
         sync = False
-        res = self.at_command('AT+CCLK?')
+        res = self.at_command(self._CMD_CCLK)
         for line in res:
-            if '+CCLK: "' in line:
+            if b'+CCLK: "' in line:
                 sync = True
                 break
         if not sync:
             raise SystemError(f'Time not synchronized: {res}')
-        self._put_file_in_flash(ca_file, 'ca.crt')
-        self._put_file_in_flash(cert_file, 'client.crt')
-        self._put_file_in_flash(key_file, 'client.key')
-        res = self.at_command('AT+CSSLCFG="CONVERT",2,"ca.crt"')
-        if not 'OK' in res:
+        files = {'ca.crt': ca_file, 'client.crt': cert_file, 'client.key': key_file}
+        self._cfs_begin()
+        try:
+            for flashname, filename in files.items():
+                self._cfs_write(_read_file(filename), flashname)
+        finally:
+            self._cfs_end()
+        res = self.at_command(self._CMD_CSSLCFG_CA)
+        if not _OK in res:
             raise SystemError(f'Failed to configure CA cert: {res}')
-        res = self.at_command('AT+CSSLCFG="CONVERT",1,"client.crt","client.key"')
-        if not 'OK' in res:
+        res = self.at_command(self._CMD_CSSLCFG_CLIENT)
+        if not _OK in res:
             raise SystemError(f'Failed to configure client/key: {res}')
         
     def mqtt_connect(self,
@@ -297,45 +629,42 @@ class WaveshareNbiotHat:
                      keepalive: int = 60,
                      ssl: bool = True) -> None:
         """"""
-        if not self._active_pdp_context:
+        if self._active_pdp_context is None:
             raise ValueError('No valid PDP context')
         if not self._pdp_contexts[self._active_pdp_context].ip_address:
             raise ValueError('No valid IP address in context')
-        res = self.at_command(f'AT+SMCONF="URL",{server_url},{server_port}')
-        if not 'OK' in res:
-            raise SystemError(f'Failed to configure MQTT server: {res}')
-        res = self.at_command(f'AT+SMCONF="KEEPTIME",{keepalive}')
-        if not 'OK' in res:
-            raise SystemError(f'Failed to configure MQTT keepalive: {res}')
-        res = self.at_command(f'AT+SMCONF="CLEANSS",1')
-        if not 'OK' in res:
-            raise SystemError(f'Failed to configure MQTT clean session: {res}')
-        res = self.at_command(f'AT+SMCONF="CLIENTID",{client_id}')
-        if not 'OK' in res:
-            raise SystemError(f'Failed to configure MQTT client ID: {res}')
+        res = self._at_batch([
+            b''.join([b'+SMCONF="URL",', server_url.encode(),
+                      b',', str(server_port).encode()]),
+            b''.join([b'+SMCONF="KEEPTIME",', str(keepalive).encode()]),
+            b'+SMCONF="CLEANSS",1',
+            b''.join([b'+SMCONF="CLIENTID",', client_id.encode()]),
+        ])
+        if not _OK in res:
+            raise SystemError(f'Failed to configure MQTT: {res}')
         if ssl:
             self.pdp_context_configure_ssl()
-            res = self.at_command('AT+SMSSL=1,"ca.crt","client.crt"')
-        res = self.at_command(f'AT+SMCONN')
-        if not 'OK' in res:
+            res = self.at_command(self._CMD_SMSSL)
+        res = self.at_command(self._CMD_SMCONN)
+        if not _OK in res:
             raise SystemError(f'Failed to connect to MQTT broker: {res}')
         self._mqtt_connected = True
     
     def mqtt_disconnect(self):
-        res = self.at_command('AT+SMDISC')
-        if not 'OK' in res:
+        res = self.at_command(self._CMD_SMDISC)
+        if not _OK in res:
             raise SystemError(f'Failed to disconnect MQTT: {res}')
         self._mqtt_connected = False
     
     def mqtt_susbscribe(self, topic: str, qos: int = 0):
         """"""
         res = self.at_command(f'AT+SMSUB="{topic}",{qos}')
-        if not 'OK' in res:
+        if not _OK in res:
             raise SystemError(f'Failed to subscribe to {topic}: {res}')
     
     def mqtt_unsubscribe(self, topic: str):
         res = self.at_command(f'AT+SMUNSUB="{topic}"')
-        if not 'OK' in res:
+        if not _OK in res:
             raise SystemError(f'Failed to unsubscribe from {topic}: {res}')
     
     def mqtt_publish(self,
@@ -345,12 +674,15 @@ class WaveshareNbiotHat:
                      retain: bool = False):
         """"""
         retain = 1 if retain is True else 0
-        res = self.at_command(f'AT+SMPUB="{topic}",{len(payload)},{qos},{retain}')
-        if '>' not in res:
-            raise SystemError(f'No prompt for MQTT payload: {res}')
-        self.uart.write(payload.encode())
-        sleep(math.ceil(len(payload) / self._baudrate))
-        if self.uart.in_waiting:
-            res = self.uart.read(self.uart.in_waiting).encode().strip()
-            if 'OK' not in res:
+        data = payload.encode()
+        with self._uart_lock:
+            res = self.at_command(b''.join([
+                b'AT+SMPUB="', topic.encode(), b'",', str(len(data)).encode(),
+                b',', str(qos).encode(), b',', str(retain).encode(), b'\r']))
+            if _PROMPT not in res:
+                raise SystemError(f'No prompt for MQTT payload: {res}')
+            self.uart.write(data)
+            self.uart.flush()
+            res = self._read_response(timeout=5)
+            if _OK not in res:
                 raise SystemError(f'Failed to publish MQTT: {res}')
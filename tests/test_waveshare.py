@@ -0,0 +1,319 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from pi_nbiot import waveshare
+
+
+class FakeSerial:
+    """Scripted stand-in for `serial.Serial` replying to written commands."""
+    def __init__(self, *args, **kwargs) -> None:
+        self.baudrate = 9600
+        self.rx = bytearray()
+        self.replies: 'dict[bytes, bytes]' = {}
+        self.written: 'list[bytes]' = []
+        self.max_read: 'int|None' = None
+    
+    @property
+    def in_waiting(self) -> int:
+        return len(self.rx)
+    
+    def read(self, size: int = 1) -> bytes:
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+    
+    def readinto(self, b) -> int:
+        size = len(b) if self.max_read is None else min(len(b), self.max_read)
+        data = self.read(size)
+        b[:len(data)] = data
+        return len(data)
+    
+    def write(self, data: bytes) -> int:
+        data = bytes(data)
+        self.written.append(data)
+        for command in data.split(b'\r')[:-1]:
+            self.rx += self.replies.get(command, b'')
+        return len(data)
+    
+    def flush(self) -> None:
+        pass
+    
+    def reset_input_buffer(self) -> None:
+        self.rx.clear()
+    
+    def set_low_latency_mode(self, enable: bool) -> None:
+        pass
+    
+    def close(self) -> None:
+        self.closed = True
+
+
+@pytest.fixture
+def hat(monkeypatch) -> waveshare.WaveshareNbiotHat:
+    monkeypatch.setattr(waveshare.serial, 'Serial', FakeSerial)
+    monkeypatch.setattr(waveshare, 'DigitalOutputDevice', lambda pin: None)
+    return waveshare.WaveshareNbiotHat()
+
+
+def test_at_command_returns_on_ok(hat):
+    hat.uart.replies[b'AT'] = b'AT\r\r\nOK\r\n'
+    assert hat.at_command('AT') == [b'AT', b'OK']
+
+
+def test_enable_rf_waits_for_cpin_after_ok(hat):
+    hat.uart.replies[b'AT+CFUN=1'] = b'\r\nOK\r\n\r\n+CPIN: READY\r\n'
+    assert hat.enable_rf()
+
+
+def test_expected_urc_timeout(hat):
+    hat.uart.replies[b'AT+CFUN=1'] = b'\r\nOK\r\n'
+    assert hat.at_command('AT+CFUN=1', timeout=0.1,
+                          expect=b'+CPIN: READY') == [b'OK']
+
+
+def test_expect_not_awaited_on_error(hat):
+    hat.uart.replies[b'AT+CFUN=1'] = b'\r\nERROR\r\n'
+    assert hat.at_command('AT+CFUN=1', expect=b'+CPIN:') == [b'ERROR']
+
+
+def test_at_batch_sends_single_command_line(hat):
+    hat.uart.replies[b'AT+A=1;+B?'] = b'+B: 2\r\nOK\r\n'
+    assert hat._at_batch([b'+A=1', b'+B?']) == [b'+B: 2', b'OK']
+    assert hat.uart.written == [b'AT+A=1;+B?\r']
+
+
+def test_mqtt_connect_configuration_error(hat):
+    hat._pdp_contexts[0] = waveshare.PdpContext(0, 'ciot', None)
+    hat._pdp_contexts[0].ip_address = '10.0.0.5'
+    hat._active_pdp_context = 0
+    hat.uart.replies[b'AT+SMCONF="URL",host,1883;+SMCONF="KEEPTIME",60;'
+                     b'+SMCONF="CLEANSS",1;+SMCONF="CLIENTID",me'] = b'ERROR\r\n'
+    with pytest.raises(SystemError, match='Failed to configure MQTT'):
+        hat.mqtt_connect('host', 1883, 'me', ssl=False)
+    assert len(hat.uart.written) == 1
+
+
+def test_read_response_joins_line_split_across_reads(hat):
+    hat.uart.max_read = 3
+    hat.uart.rx += b'\r\n+CNACT: 0,1,"10.0.0.5"\r\nOK\r\n'
+    assert hat._read_response(timeout=1) == [b'+CNACT: 0,1,"10.0.0.5"', b'OK']
+
+
+def test_read_response_compacts_partial_line_at_buffer_end(hat):
+    hat.uart.max_read = 300
+    lines = [b'+LINE: %03d ' % i + b'x' * 90 for i in range(40)]
+    hat.uart.rx += b'\r\n'.join(lines) + b'\r\nOK\r\n'
+    assert hat._read_response(timeout=1) == lines + [b'OK']
+
+
+def test_read_response_returns_line_longer_than_buffer(hat):
+    hat.uart.max_read = 1000
+    long_line = b'+SMSUB: "t","' + b'x' * 5000 + b'"'
+    hat.uart.rx += long_line + b'\r\nOK\r\n'
+    assert hat._read_response(timeout=1) == [long_line, b'OK']
+
+
+def test_read_response_handles_crlf_split_at_buffer_end(hat):
+    size = len(hat._rx_buf)
+    line = b'+X: ' + b'x' * (size - 5)   # <cr> lands in the last byte
+    hat.uart.rx += line + b'\r\nOK\r\n'
+    assert hat._read_response(timeout=1) == [line, b'OK']
+
+
+def test_long_urc_goes_to_handler_whole(hat, caplog):
+    urcs = []
+    hat.on_urc('+SMSUB:', urcs.append)
+    long_urc = b'+SMSUB: "t","' + b'x' * 5000 + b'"'
+    hat.uart.replies[b'AT'] = long_urc + b'\r\nOK\r\n'
+    assert hat.at_command('AT') == [b'OK']
+    assert urcs == [long_urc]
+    assert 'Buffer contained' not in caplog.text
+
+
+def test_at_command_returns_unterminated_prompt(hat):
+    hat.uart.replies[b'AT+SMPUB="t",5,0,0'] = b'AT+SMPUB="t",5,0,0\r\r\n> '
+    assert hat.at_command('AT+SMPUB="t",5,0,0', timeout=1)[-1] == b'>'
+    assert not hat.uart.rx
+
+
+def test_read_response_routes_leftover_data_on_close(hat, caplog):
+    urcs = []
+    hat.on_urc('+APP PDP:', urcs.append)
+    hat.uart.rx += b'OK\r\n+APP PDP: 0,ACTIVE\r\n+UNKNOWN\r\n'
+    assert hat._read_response(timeout=1) == [b'OK']
+    assert urcs == [b'+APP PDP: 0,ACTIVE']
+    assert 'Buffer contained: +UNKNOWN' in caplog.text
+
+
+def test_probe_tries_current_baudrate_first(hat):
+    hat.uart.baudrate = 115200
+    hat.uart.replies[b'AT'] = b'OK\r\n'
+    assert hat._probe(timeout=0.1)
+    assert hat.uart.baudrate == 115200
+    assert hat.uart.written == [b'AT\r']
+
+
+def test_urc_during_command_goes_to_handler(hat):
+    urcs = []
+    hat.on_urc('+SMSUB:', urcs.append)
+    hat.uart.replies[b'AT+SMSUB="t",0'] = b'+SMSUB: "t","msg"\r\nOK\r\n'
+    assert hat.at_command('AT+SMSUB="t",0') == [b'OK']
+    assert urcs == [b'+SMSUB: "t","msg"']
+
+
+def test_expected_lines_exempt_from_urc_handlers(hat):
+    urcs = []
+    hat.on_urc('+CPIN:', urcs.append)
+    hat.on_urc('+CNACT:', urcs.append)
+    hat.uart.replies[b'AT+CFUN=1'] = b'OK\r\n+CPIN: READY\r\n'
+    hat.uart.replies[b'AT+CNACT?'] = b'+CNACT: 0,1,"10.0.0.5"\r\nOK\r\n'
+    assert hat.enable_rf()
+    assert hat.at_command('AT+CNACT?') == [b'+CNACT: 0,1,"10.0.0.5"', b'OK']
+    assert urcs == []
+
+
+class RateSwitchingSerial(FakeSerial):
+    """Fake modem that only answers at its own rate and honours AT+IPR."""
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.module_rate = 9600
+        self.next_rate: 'int|None' = None
+    
+    def write(self, data: bytes) -> int:
+        self.written.append(bytes(data))
+        if self.baudrate != self.module_rate:
+            return len(data)
+        if data == b'AT\r':
+            self.rx += b'OK\r\n'
+        elif data.startswith(b'AT+IPR='):
+            self.rx += b'OK\r\n'
+            self.module_rate = self.next_rate
+        return len(data)
+
+
+@pytest.fixture
+def rate_hat(monkeypatch) -> waveshare.WaveshareNbiotHat:
+    monkeypatch.setattr(waveshare.serial, 'Serial', RateSwitchingSerial)
+    monkeypatch.setattr(waveshare, 'DigitalOutputDevice', lambda pin: None)
+    return waveshare.WaveshareNbiotHat(baudrate=115200)
+
+
+def test_initialize_negotiates_baudrate(rate_hat):
+    rate_hat.uart.next_rate = 115200
+    assert rate_hat.initialize()
+    assert rate_hat.uart.baudrate == 115200
+
+
+def test_initialize_reprobes_when_new_rate_fails(rate_hat):
+    rate_hat.uart.next_rate = 9600   # acknowledged but not applied
+    assert rate_hat.initialize()
+    assert rate_hat.uart.baudrate == 9600
+
+
+def test_initialize_not_ready_when_link_lost(rate_hat):
+    rate_hat.uart.next_rate = 57600
+    assert not rate_hat.initialize(max_attempts=1)
+    assert not rate_hat.ready
+
+
+def test_at_command_async_preserves_order(hat):
+    hat.uart.replies.update({b'A': b'+A: 1\r\nOK\r\n', b'B': b'+B: 2\r\nOK\r\n'})
+    
+    async def send_both():
+        return await asyncio.gather(hat.at_command_async('A'),
+                                    hat.at_command_async('B'))
+    
+    assert asyncio.run(send_both()) == [[b'+A: 1', b'OK'], [b'+B: 2', b'OK']]
+    hat.close()
+    assert hat.uart.closed
+
+
+def test_at_command_async_forwards_expect(hat):
+    hat.uart.replies[b'AT+CFUN=1'] = b'OK\r\n+CPIN: READY\r\n'
+    res = asyncio.run(hat.at_command_async('AT+CFUN=1', expect=b'+CPIN:'))
+    assert res == [b'OK', b'+CPIN: READY']
+
+
+def test_sync_and_async_commands_do_not_interleave(hat):
+    for i in range(20):
+        hat.uart.replies[b'S%d' % i] = b'+S: %d\r\nOK\r\n' % i
+        hat.uart.replies[b'Q%d' % i] = b'+Q: %d\r\nOK\r\n' % i
+    write = hat.uart.write
+    
+    def slow_write(data):
+        written = write(data)
+        time.sleep(0.001)   # let the other thread run while the reply waits
+        return written
+    
+    hat.uart.write = slow_write
+    sync_results = []
+    
+    def send_sync():
+        for i in range(20):
+            sync_results.append(hat.at_command(f'S{i}', timeout=1))
+    
+    async def send_async():
+        return await asyncio.gather(*[hat.at_command_async(f'Q{i}', timeout=1)
+                                      for i in range(20)])
+    
+    thread = threading.Thread(target=send_sync)
+    thread.start()
+    async_results = asyncio.run(send_async())
+    thread.join()
+    assert sync_results == [[b'+S: %d' % i, b'OK'] for i in range(20)]
+    assert async_results == [[b'+Q: %d' % i, b'OK'] for i in range(20)]
+
+
+def test_process_urcs_routes_to_handlers(hat, caplog):
+    urcs = []
+    hat.on_urc('+SMSUB:', urcs.append)
+    hat.uart.rx += b'\r\n+SMSUB: "t","msg"\r\n+OTHER: 1\r\n'
+    hat.process_urcs(timeout=0.1)
+    assert urcs == [b'+SMSUB: "t","msg"']
+    assert 'Buffer contained: +OTHER: 1' in caplog.text
+
+
+def test_configure_ssl_uploads_files_in_one_session(hat, tmp_path):
+    files = []
+    for name in ('ca.pem', 'cert.pem', 'key.pem'):
+        path = tmp_path / name
+        path.write_bytes(name.encode() * 30)   # one upload chunk
+        files.append(str(path))
+    hat._pdp_contexts[0] = waveshare.PdpContext(0, 'ciot', None)
+    hat._pdp_contexts[0].ip_address = '10.0.0.5'
+    hat._active_pdp_context = 0
+    hat.uart.replies.update({
+        b'AT+CCLK?': b'+CCLK: "24/01/01,00:00:00+00"\r\nOK\r\n',
+        b'AT+CFSINIT': b'OK\r\n',
+        b'AT+CFSTERM': b'OK\r\n',
+        b'AT+CSSLCFG="CONVERT",2,"ca.crt"': b'OK\r\n',
+        b'AT+CSSLCFG="CONVERT",1,"client.crt","client.key"': b'OK\r\n',
+    })
+    write = hat.uart.write
+    
+    def write_file(data):
+        data = bytes(data)
+        if data.startswith(b'AT+CFSWFILE'):
+            hat.uart.rx += b'DOWNLOAD\r\n'
+        elif not data.startswith(b'AT'):
+            hat.uart.rx += b'OK\r\n'
+        return write(data)
+    
+    hat.uart.write = write_file
+    hat.pdp_context_configure_ssl(*files)
+    commands = [data for data in hat.uart.written if data.startswith(b'AT')]
+    assert commands.count(b'AT+CFSINIT\r') == 1
+    assert commands.count(b'AT+CFSTERM\r') == 1
+    assert b''.join(hat.uart.written).count(b'ca.pem' * 30) == 1
+
+
+def test_pdp_context_configure_command(hat):
+    hat._pdp_contexts[0] = waveshare.PdpContext(0, 'ciot',
+                                                waveshare.DataService.IP_V4)
+    hat.uart.replies[b'AT+CNCFG=0,"IP","ciot",user,pass,3'] = b'OK\r\n'
+    hat.pdp_context_configure(0, username='user', password='pass',
+                              auth=waveshare.AuthType.PAP_CHAP)
+    assert hat.pdp_contexts[0].configured